@@ -1,138 +1,187 @@
 from mesa import Agent
-import random
 import math
 from .logger import logger
 import numpy as np
 
+# moves and strategies are interned as these integer codes, which index the model's arrays and payoff matrix
+MOVE_CODES = {"R": 0, "P": 1, "S": 2, "E": 3}
+STRATEGY_CODES = {"all_r": 0, "all_p": 1, "all_s": 2, "empty": 3}
+MOVE_NAMES = list(MOVE_CODES)
+STRATEGY_NAMES = list(STRATEGY_CODES)
+EMPTY = STRATEGY_CODES["empty"]
+# the move that each strategy plays, indexed by strategy code
+STRATEGY_TO_MOVE = np.array([MOVE_CODES["R"], MOVE_CODES["P"], MOVE_CODES["S"], MOVE_CODES["E"]], dtype=np.int8)
+
+
 def round_to_unity(probabilities):
-    probs_round = [np.floor(prob) for prob in probabilities]
-    remainder = [(probabilities[i] - prob_round) for (i, prob_round) in enumerate(probs_round)]
-    while sum(probs_round) < 1:
-        key = np.argmax(remainder)
-        probs_round[key] += 1
-        remainder[key] = 0
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    probs_round = np.floor(probabilities)
+    deficit = max(int(round(1 - probs_round.sum())), 0)
+    # the largest remainders are rounded up first, the stable sort keeps the lowest index on a tie
+    probs_round[np.argsort(probs_round - probabilities, kind='stable')[:deficit]] += 1
     return probs_round
 
 
 class GameAgent(Agent):
 
+    # the agent's state lives in the model's arrays, so the only instance attributes are slots. mesa's Agent is not
+    # slotted and still keeps a __dict__ for unique_id and model
+    __slots__ = ('pos', 'flat_id', 'next_move', 'neighbors', 'neighbor_ids')
+
     unique_id = 1
 
     def __init__(self, pos, model):
         super().__init__(GameAgent.unique_id, model)
         GameAgent.unique_id += 1
         self.pos = pos
+        # the index of this agent in the model's raveled grids and neighbour table
+        self.flat_id = pos[0] * model.height + pos[1]
 
-        # the length of this array is 8 as their are 8 neighbours for every agent
-        self.scores = [0, 0, 0, 0, 0, 0, 0, 0]
-        self.total_score = 0
-
-        self.move = None
         self.next_move = None
 
-        self.strategy = ""
-        self.new_strategy = ""
-        self.alive = True
         # self.crowded = []
         self.neighbors = []
+        self.neighbor_ids = np.empty(0, dtype=np.int32)
 
-        if self.model.biomes:
-            for i in range(len(self.model.biome_boundaries)-1):
-                if self.model.biome_boundaries[i] <= self.pos[0] < self.model.biome_boundaries[i+1]:
-                    self.strategy = self.model.agent_strategies[i]
-        else:
-            self.strategy = np.random.choice(a=self.model.agent_strategies, p=self.model.initial_population_sizes)
+        self.strategy_code = self.model.initial_strategies[self.flat_id]
+
+    # the strategy and move of the agent are stored as codes in the model's arrays, the names are only looked up
+    # for display
+
+    @property
+    def strategy_code(self):
+        return self.model.strategies[self.flat_id]
+
+    @strategy_code.setter
+    def strategy_code(self, strategy_code):
+        self.model.strategies[self.flat_id] = strategy_code
+
+    @property
+    def new_strategy_code(self):
+        return self.model.new_strategies[self.flat_id]
+
+    @new_strategy_code.setter
+    def new_strategy_code(self, strategy_code):
+        self.model.new_strategies[self.flat_id] = strategy_code
+
+    @property
+    def move_code(self):
+        return self.model.moves[self.flat_id]
 
-    def kill_weak(self):
-        if random.random() < self.model.probability_death and self.alive:
-            self.neighbors = self.model.grid.get_neighbors(self.pos, moore=True)
-            # if all(self.strategy == neighbour.strategy for neighbour in self.neighbors) and self.model.kill_crowded:
-            #     self.alive = False
+    @move_code.setter
+    def move_code(self, move_code):
+        self.model.moves[self.flat_id] = move_code
 
-            if self.total_score < self.model.cull_score:
-                self.model.num_dying += 1
-                self.alive = False
+    @property
+    def strategy(self):
+        return STRATEGY_NAMES[self.strategy_code]
+
+    @strategy.setter
+    def strategy(self, strategy):
+        self.strategy_code = STRATEGY_CODES[strategy]
+
+    @property
+    def new_strategy(self):
+        return STRATEGY_NAMES[self.new_strategy_code]
+
+    @property
+    def move(self):
+        return MOVE_NAMES[self.move_code]
+
+    @property
+    def scores(self):
+        """
+        The score against each neighbour this step, in the same order as grid.get_neighbors.
+        """
+        return self.model.scores[self.flat_id][self.model.neighbour_mask[self.flat_id]]
+
+    @property
+    def total_score(self):
+        return self.model.total_scores[self.flat_id]
+
+    @property
+    def alive(self):
+        return self.model.alive[self.flat_id]
+
+    @alive.setter
+    def alive(self, alive):
+        self.model.alive[self.flat_id] = alive
 
     def reproduce_strong(self):
-        self.neighbors = self.model.grid.get_neighbors(self.pos, moore=True)
+        mutating = self.model._mut_rand[self.flat_id] < self.model.probability_mutation
+        if self.alive and not mutating:
+            # most agents are alive and keep their strategy, so they skip the neighbour lookups and logging below
+            self.new_strategy_code = self.strategy_code
+            return
+
         logger.warn("Alive: {}"
                     "\nStrategy: {}"
                     "\nPosition: {}"
-                    "\nScores (total): {} {}".format(self.alive, self.strategy, self.pos, self.scores, self.total_score))
+                    "\nScores (total): {} {}".format(self.alive, self.strategy, self.pos, self.scores.tolist(), self.total_score))
         if not self.alive:
-            if random.random() < self.model.probability_adoption:
-                if self.strategy == "empty":
-                    self.new_strategy = self.neighbors[np.argmax(
-                            [neighbor.total_score for neighbor in self.neighbors])].strategy
+            if self.model._adopt_rand[self.flat_id] < self.model.probability_adoption:
+                if self.strategy_code == EMPTY:
+                    strongest_neighbor = self.neighbor_ids[self.model.total_scores[self.neighbor_ids].argmax()]
+                    self.new_strategy_code = self.model.strategies[strongest_neighbor]
                     logger.warn("Empty strategy adopting...")
-                    self.model.num_dead -= 1
                 else:
                     # the strongest neighbour is that which beat self the most
-                    self.new_strategy = self.neighbors[np.argmin(self.scores)].strategy
+                    self.new_strategy_code = self.model.strategies[self.neighbor_ids[self.scores.argmin()]]
                     logger.warn("Strategy of all neighbours {}".format([neighbor.strategy for neighbor in self.neighbors]))
                     logger.warn("Dead agent adopting...")
                 self.alive = True
                 self.model.num_evolving += 1
             else:
-                self.new_strategy = "empty"
-                if self.strategy != "empty":
+                self.new_strategy_code = EMPTY
+                if self.strategy_code != EMPTY:
                     logger.warn("Dead agent became empty...")
-                    self.model.num_dead += 1
                 else:
                     logger.warn("Empty agent did not change its state...")
         else:
-            logger.warn("This agent did not change its strategy...")
-            self.new_strategy = self.strategy
+            # only living agents that are about to mutate reach here
+            self.new_strategy_code = self.strategy_code
 
-        if random.random() < self.model.probability_mutation:
-            available_strategies = [strategy for strategy in self.model.agent_strategies if
-                                    strategy != self.strategy]
-            self.new_strategy = random.choice(available_strategies)
+        if mutating:
+            available_strategies = [strategy for strategy in self.model.agent_strategy_codes if
+                                    strategy != self.strategy_code]
+            choice = int(self.model._mut_choice_rand[self.flat_id] * len(available_strategies))
+            self.new_strategy_code = available_strategies[choice]
 
-            if self.strategy == "empty":
-                self.model.num_dead -= 1
+            if self.strategy_code == EMPTY:
                 logger.warn("Dead agent mutating...")
             else:
                 logger.warn("Agent mutating...")
             self.model.num_mutating += 1
 
+        # a cell is counted as dead while it is empty, so only a change into or out of empty moves the count. An
+        # empty cell that adopts an empty neighbour stays dead
+        if self.strategy_code == EMPTY and self.new_strategy_code != EMPTY:
+            self.model.num_dead -= 1
+        elif self.strategy_code != EMPTY and self.new_strategy_code == EMPTY:
+            self.model.num_dead += 1
+
         logger.warn("New Strategy: {}".format(self.new_strategy))
 
     def exchange(self):
-        self.neighbors = self.model.grid.get_neighbors(self.pos, moore=True)
-        if random.random() < self.model.probability_exchange:
-            random_neighbor = random.choice([neighbor for neighbor in self.neighbors])
-            self.new_strategy = random_neighbor.strategy
-            random_neighbor.new_strategy = self.strategy
+        if self.model._exchange_rand[self.flat_id] < self.model.probability_exchange:
+            choice = int(self.model._exchange_choice_rand[self.flat_id] * len(self.neighbors))
+            random_neighbor = self.neighbors[choice]
+            self.new_strategy_code = random_neighbor.strategy_code
+            random_neighbor.new_strategy_code = self.strategy_code
         else:
-            self.new_strategy = self.strategy
+            self.new_strategy_code = self.strategy_code
 
 class RPSAgent(GameAgent):
 
+    __slots__ = ()
+
     def __init__(self, pos, model):
         super().__init__(pos, model)
 
         self.implement_strategy()
 
-    def increment_score(self):
-        for num, neighbor in enumerate(self.model.grid.neighbor_iter(self.pos)):
-            self.scores[num] = 0
-            if random.random() < self.model.probability_playing:
-                self.scores[num] += self.model.payoff[self.move, neighbor.move]
-        self.total_score = sum(self.scores)
-
     def implement_strategy(self):
-        if self.strategy == "all_r":
-            self.move = "R"
-        elif self.strategy == "all_p":
-            self.move = "P"
-        elif self.strategy == "all_s":
-            self.move = "S"
-        elif self.strategy == "empty":
-            self.move = "E"
-
-    def update_strategy(self):
-        self.strategy = self.new_strategy
+        self.move_code = STRATEGY_TO_MOVE[self.strategy_code]
 
 
 
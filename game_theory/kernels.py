@@ -0,0 +1,168 @@
+import os
+import numpy as np
+from .agent import EMPTY
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# the backend that runs a step, "numba" compiles the kernels in this module while "python" scores with numpy and
+# leaves the remaining passes to the agents' own methods. The numba compile time only pays off on larger grids, so
+# the python backend can be picked with the GAME_THEORY_BACKEND environment variable even when numba is installed
+BACKEND = os.environ.get("GAME_THEORY_BACKEND", "numba" if numba is not None else "python")
+if BACKEND not in ("numba", "python"):
+    raise ValueError("Unknown GAME_THEORY_BACKEND {}, expected numba or python".format(BACKEND))
+if BACKEND == "numba" and numba is None:
+    raise ImportError("GAME_THEORY_BACKEND=numba requires numba to be installed")
+compiled = BACKEND == "numba"
+
+
+def score_all_numpy(moves, payoff, neighbour_idx, played, out_scores, out_totals):
+    """
+    Args:
+        moves: the move code of every cell, raveled from the move grid
+        payoff: the payoff matrix indexed by (my_move, other_move)
+        neighbour_idx: the flat index of each of the neighbours of every cell
+        played: whether each cell played each of its neighbours this step
+        out_scores: filled with the score of every cell against each of its neighbours
+        out_totals: filled with the total score of every cell
+    Notes:
+        Used by the python backend, this evaluates the whole grid with a single gather.
+    """
+    out_scores[:] = payoff[moves[:, np.newaxis], moves[neighbour_idx]]
+    out_scores *= played
+    out_scores.sum(axis=1, out=out_totals)
+
+
+if compiled:
+    @numba.njit(parallel=True, cache=True, fastmath=True)
+    def score_all(moves, payoff, neighbour_idx, played, out_scores, out_totals):
+        """
+        Compiled version of score_all_numpy, the cells are scored in parallel without building the intermediate
+        arrays of the gather.
+        """
+        for i in numba.prange(neighbour_idx.shape[0]):
+            total = 0.0
+            for k in range(neighbour_idx.shape[1]):
+                score = 0.0
+                if played[i, k]:
+                    score = payoff[moves[i], moves[neighbour_idx[i, k]]]
+                out_scores[i, k] = score
+                total += score
+            out_totals[i] = total
+else:
+    score_all = score_all_numpy
+
+
+if compiled:
+    @numba.njit(parallel=True, cache=True)
+    def reproduce_all(strategies, alive, total_scores, scores, neighbour_idx, neighbour_mask, agent_strategy_codes,
+                      adopt_rand, mut_rand, mut_choice_rand, probability_adoption, probability_mutation,
+                      new_strategies):
+        """
+        Args:
+            strategies: the strategy code of every agent, only read
+            alive: whether every agent is alive, dead agents that adopt a strategy are brought back to life
+            total_scores: the total score of every agent this step
+            scores: the score of every agent against each of its neighbours this step
+            neighbour_idx: the flat index of each of the neighbours of every agent
+            neighbour_mask: whether each entry of neighbour_idx is a real neighbour
+            agent_strategy_codes: the codes of the strategies an agent can mutate to
+            adopt_rand, mut_rand, mut_choice_rand: this step's uniform random numbers for every agent
+            probability_adoption: the probability that a dead agent adopts a neighbour's strategy
+            probability_mutation: the probability that an agent mutates
+            new_strategies: filled with the strategy code every agent takes on
+        Returns:
+            The change in the number of dead agents, the number of agents evolving and the number mutating.
+        Notes:
+            The same rules as GameAgent.reproduce_strong. Each agent only writes its own entries so the agents are
+            updated in parallel, the new strategies are double buffered and copied over by the model afterwards.
+        """
+        # numba reductions take a single operator, so cells emptied and cells filled are counted separately
+        num_emptied = 0
+        num_filled = 0
+        num_evolving = 0
+        num_mutating = 0
+        for i in numba.prange(len(strategies)):
+            strategy = strategies[i]
+            new_strategy = strategy
+            if not alive[i]:
+                if adopt_rand[i] < probability_adoption:
+                    if strategy == EMPTY:
+                        # an empty cell is taken over by the neighbour with the highest total score
+                        best = -1
+                        for k in range(neighbour_idx.shape[1]):
+                            j = neighbour_idx[i, k]
+                            if neighbour_mask[i, k] and (best < 0 or total_scores[j] > total_scores[best]):
+                                best = j
+                        new_strategy = strategies[best]
+                    else:
+                        # the strongest neighbour is that which beat self the most
+                        best = -1
+                        for k in range(neighbour_idx.shape[1]):
+                            if neighbour_mask[i, k] and (best < 0 or scores[i, k] < scores[i, best]):
+                                best = k
+                        new_strategy = strategies[neighbour_idx[i, best]]
+                    alive[i] = True
+                    num_evolving += 1
+                else:
+                    new_strategy = EMPTY
+
+            if mut_rand[i] < probability_mutation:
+                num_available = 0
+                for code in agent_strategy_codes:
+                    if code != strategy:
+                        num_available += 1
+                choice = int(mut_choice_rand[i] * num_available)
+                for code in agent_strategy_codes:
+                    if code != strategy:
+                        if choice == 0:
+                            new_strategy = code
+                            break
+                        choice -= 1
+                num_mutating += 1
+
+            # a cell is counted as dead while it is empty, so only a change into or out of empty moves the count
+            if strategy == EMPTY and new_strategy != EMPTY:
+                num_filled += 1
+            elif strategy != EMPTY and new_strategy == EMPTY:
+                num_emptied += 1
+            new_strategies[i] = new_strategy
+        return num_emptied - num_filled, num_evolving, num_mutating
+
+
+    @numba.njit(cache=True)
+    def exchange_all(agent_order, strategies, neighbour_idx, neighbour_mask, exchange_rand, exchange_choice_rand,
+                     probability_exchange, new_strategies):
+        """
+        Args:
+            agent_order: the flat indices of the agents in the order they are activated
+            strategies: the strategy code of every agent, only read
+            neighbour_idx: the flat index of each of the neighbours of every agent
+            neighbour_mask: whether each entry of neighbour_idx is a real neighbour
+            exchange_rand, exchange_choice_rand: this step's uniform random numbers for every agent
+            probability_exchange: the probability that an agent swaps strategies with a random neighbour
+            new_strategies: filled with the strategy code every agent takes on
+        Notes:
+            The same rules as GameAgent.exchange. An exchange writes to a neighbour as well as to the agent itself, so
+            the agents are visited one after another in the activation order rather than in parallel. Nothing copies
+            new_strategies back after this pass, so like GameAgent.exchange it has no effect on the grid.
+        """
+        for i in agent_order:
+            if exchange_rand[i] < probability_exchange:
+                num_neighbours = 0
+                for k in range(neighbour_idx.shape[1]):
+                    if neighbour_mask[i, k]:
+                        num_neighbours += 1
+                choice = int(exchange_choice_rand[i] * num_neighbours)
+                for k in range(neighbour_idx.shape[1]):
+                    if neighbour_mask[i, k]:
+                        if choice == 0:
+                            j = neighbour_idx[i, k]
+                            new_strategies[i] = strategies[j]
+                            new_strategies[j] = strategies[i]
+                            break
+                        choice -= 1
+            else:
+                new_strategies[i] = strategies[i]
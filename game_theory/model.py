@@ -1,12 +1,21 @@
 from mesa.datacollection import DataCollector
 from mesa.space import SingleGrid
 from mesa import Model
-from mesa.time import RandomActivation
-from .agent import RPSAgent
+from .agent import RPSAgent, MOVE_CODES, STRATEGY_CODES, STRATEGY_TO_MOVE, EMPTY
+from .kernels import score_all, compiled
+if compiled:
+    from .kernels import reproduce_all, exchange_all
 import numpy as np
 import random
 from .logger import logger
 
+# the rgb colour each strategy is drawn with by the server, indexed by STRATEGY_CODES (red, green, blue, black)
+STRATEGY_COLOURS = np.array([[255, 0, 0], [0, 128, 0], [0, 0, 255], [0, 0, 0]], dtype=np.uint8)
+
+# (dx, dy) of each Moore neighbour, in the same order that grid.get_neighbors returns them
+NEIGHBOUR_OFFSETS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
+
 def key(x, y):
     """
     Args:
@@ -32,16 +41,12 @@ def biome_boundaries(initial_population_probabilities, width):
         This is a form of allocation problem, here I have used the algorithm called the Hungarian Algorithm
         https://hackernoon.com/the-assignment-problem-calculating-the-minimum-matrix-sum-python-1bba7d15252d
     """
-    exact_split = [(prob*width) for prob in initial_population_probabilities]
-    probs_round = [int(np.floor(split)) for split in exact_split]
-    remainder = [(exact_split[i] - prob_round) for (i, prob_round) in enumerate(probs_round)]
-    while sum(probs_round) < width:
-        index = int(np.argmax(remainder))
-        probs_round[index] += 1
-        remainder[index] = 0
-    probs_round.append(0)
-    probs_round.sort()
-    cumulative = np.cumsum(probs_round)
+    exact_split = np.asarray(initial_population_probabilities, dtype=np.float64) * width
+    probs_round = np.floor(exact_split).astype(int)
+    deficit = max(width - int(probs_round.sum()), 0)
+    # largest remainder method, the stable sort keeps the lowest index on a tie
+    probs_round[np.argsort(probs_round - exact_split, kind='stable')[:deficit]] += 1
+    cumulative = np.cumsum(np.sort(np.append(probs_round, 0)))
     # this ensures that the strategy generation goes onto the last column in the grid
     cumulative[-1] += 1
     return cumulative
@@ -78,10 +83,60 @@ class GameGrid(Model):
             self.grid = SingleGrid(self.width, self.height, torus=config['periodic_BC'])
 
         self.step_num = 0
+        # a single generator for every numpy draw the model and its agents make. It is seeded from the config when a
+        # seed is given, otherwise from numpy's global state so that np.random.seed still makes runs reproducible
+        seed = config.get('seed')
+        if seed is None:
+            seed = np.random.randint(2 ** 32, dtype=np.uint64)
+        self.rng = np.random.default_rng(seed)
+
+        # the state of every cell is held as integer codes in arrays indexed [x, y] so that a whole step can be
+        # evaluated with vectorised lookups, the agents read and write their own cell
+        self.move_grid = np.full((self.width, self.height), MOVE_CODES["E"], dtype=np.int8)
+        self.strategy_grid = np.full((self.width, self.height), STRATEGY_CODES["empty"], dtype=np.int8)
+        # flat views of the grids indexed by the agents' flat_id
+        self.moves = self.move_grid.ravel()
+        self.strategies = self.strategy_grid.ravel()
+        self.new_strategies = self.strategies.copy()
+
+        # the neighbours of every cell as flat indices (x * height + y) into the raveled grids, computed once as the
+        # grid never changes shape
+        x, y = np.divmod(np.arange(self.width * self.height), self.height)
+        self.neighbour_idx = np.empty((x.size, len(NEIGHBOUR_OFFSETS)), dtype=np.int32)
+        self.neighbour_mask = np.ones(self.neighbour_idx.shape, dtype=bool)
+        for num, (dx, dy) in enumerate(NEIGHBOUR_OFFSETS):
+            self.neighbour_idx[:, num] = ((x + dx) % self.width) * self.height + (y + dy) % self.height
+            if not config['periodic_BC']:
+                # without periodic boundaries the neighbours wrapped around the edges do not exist
+                self.neighbour_mask[:, num] = (0 <= x + dx) & (x + dx < self.width) & (0 <= y + dy) & (y + dy < self.height)
+        # on a torus with a side of 1 or 2 several offsets wrap onto the same cell, like mesa each distinct neighbour is
+        # only kept the first time it appears
+        for num in range(1, len(NEIGHBOUR_OFFSETS)):
+            for previous in range(num):
+                self.neighbour_mask[:, num] &= ~(self.neighbour_mask[:, previous] &
+                                                 (self.neighbour_idx[:, num] == self.neighbour_idx[:, previous]))
+        self.agents_flat = np.empty(len(self.neighbour_idx), dtype=object)
+        # the order the agents are activated in, shuffled once at the start of every step
+        self.agent_order = np.arange(len(self.neighbour_idx))
+
+        # per agent state kept as flat arrays indexed by the agent's flat_id
+        self.scores = np.zeros(self.neighbour_idx.shape)
+        self.total_scores = np.zeros(len(self.neighbour_idx))
+        self.alive = np.ones(len(self.neighbour_idx), dtype=bool)
+
+        # buffers for every step's random numbers and masks, refilled in place rather than reallocated each step
+        self._step_rand = np.empty((6, len(self.neighbour_idx)))
+        (self._death_rand, self._adopt_rand, self._mut_rand, self._mut_choice_rand,
+         self._exchange_rand, self._exchange_choice_rand) = self._step_rand
+        self._play_rand = np.empty(self.neighbour_idx.shape)
+        self._played = np.empty(self.neighbour_idx.shape, dtype=bool)
+        self._dying = np.empty(len(self.neighbour_idx), dtype=bool)
 
         self.num_moves_per_set = config['num_moves_per_set']
 
-        self.initial_population_sizes = config['initial_population_sizes']
+        # normalised once here rather than by every agent that draws its strategy from it
+        self.initial_population_sizes = np.array(config['initial_population_sizes'], dtype=np.float64)
+        self.initial_population_sizes /= self.initial_population_sizes.sum()
         self.biomes = config['biomes']
         if self.biomes:
             self.biome_boundaries = biome_boundaries(self.initial_population_sizes, self.width)
@@ -96,9 +151,19 @@ class GameGrid(Model):
         self.probability_death = config['probability_death']
 
         self.agent_strategies = config['agent_strategies']
+        self.agent_strategy_codes = np.array([STRATEGY_CODES[strategy] for strategy in self.agent_strategies],
+                                             dtype=np.int8)
+        # the starting strategy of every agent is set for the whole grid at once, the agents look theirs up by flat_id
+        if self.biomes:
+            # each column takes the strategy of the biome whose boundaries it lies between
+            x = np.arange(len(self.neighbour_idx)) // self.height
+            biome = np.searchsorted(self.biome_boundaries, x, side='right') - 1
+            self.initial_strategies = self.agent_strategy_codes[biome]
+        else:
+            self.initial_strategies = self.rng.choice(self.agent_strategy_codes, size=len(self.neighbour_idx),
+                                                      p=self.initial_population_sizes)
         self.agent_moves = config['agent_moves']
 
-        self.schedule = RandomActivation(self)
         self.running = True
 
         # self.datacollector_populations = DataCollector()
@@ -111,7 +176,31 @@ class GameGrid(Model):
         self.num_dying = 0
         self.num_evolving = 0
         self.fraction_evolving = 0
-        self.crowded_players = []
+
+        self._pop_counts = np.zeros(len(STRATEGY_CODES), dtype=int)
+        self._score_counts = np.zeros(len(STRATEGY_CODES))
+
+    def index_agents(self):
+        """
+        Hands each agent its neighbours from the neighbour table, once every agent has been placed.
+        """
+        for agent in self.agents_flat:
+            agent.neighbor_ids = self.neighbour_idx[agent.flat_id][self.neighbour_mask[agent.flat_id]]
+            agent.neighbors = list(self.agents_flat[agent.neighbor_ids])
+
+    def count_strategies(self):
+        """
+        Histograms the population and total score of every strategy in one pass over the strategy grid, the
+        datacollectors then read these counts through count_populations and count_scores.
+        """
+        self._pop_counts = np.bincount(self.strategies, minlength=len(STRATEGY_CODES))
+        self._score_counts = np.bincount(self.strategies, weights=self.total_scores, minlength=len(STRATEGY_CODES))
+
+    def update_colours(self):
+        """
+        Looks up the colour of every cell from its strategy once per step, so the server only has to read it.
+        """
+        self.color_grid = STRATEGY_COLOURS[self.strategy_grid]
 
     def run(self, n):
         ''' Run the model for n steps. '''
@@ -122,52 +211,38 @@ class GameGrid(Model):
     @staticmethod
     def count_populations(model, agent_strategy):
         """
-        Helper method to count agents with a given strategy in a given model.
+        Helper method to count agents with a given strategy in a given model, read from the counts made by
+        count_strategies at the end of the step.
         """
-        count_pop = 0
-        for agent in model.schedule.agents:
-            if agent.strategy == agent_strategy:
-                count_pop += 1
-        return count_pop
+        return int(model._pop_counts[STRATEGY_CODES[agent_strategy]])
 
     @staticmethod
     def count_scores(model, agent_strategy):
         """
-        Helper method to count total scores in a given condition in a given model.
+        Helper method to count total scores in a given condition in a given model, read from the counts made by
+        count_strategies at the end of the step.
         """
-        count_score = 0
-        for agent in model.schedule.agents:
-            if agent.strategy == agent_strategy:
-                count_score += agent.total_score
-        return count_score
+        return float(model._score_counts[STRATEGY_CODES[agent_strategy]])
 
 
 class RPSModel(GameGrid):
     def __init__(self, config):
         super().__init__(config)
         self.epsilon = config['epsilon']
-        self.payoff = {("R", "R"): 0,
-                       ("R", "P"): -self.epsilon,
-                       ("R", "S"): 1,
-                       ("R", "E"): 0,
-                       ("P", "R"): 1,
-                       ("P", "P"): 0,
-                       ("P", "S"): -self.epsilon,
-                       ("P", "E"): 0,
-                       ("S", "R"): -self.epsilon,
-                       ("S", "P"): 1,
-                       ("S", "S"): 0,
-                       ("S", "E"): 0,
-                       ("E", "R"): 0,
-                       ("E", "P"): 0,
-                       ("E", "S"): 0,
-                       ("E", "E"): 0}
+        # the payoff for the agent making the row move against the column move, indexed by MOVE_CODES (R, P, S, E)
+        self.payoff_matrix = np.array([[0, -self.epsilon, 1, 0],
+                                       [1, 0, -self.epsilon, 0],
+                                       [-self.epsilon, 1, 0, 0],
+                                       [0, 0, 0, 0]], dtype=np.float64)
 
         for x in range(self.width):
             for y in range(self.height):
                 agent = RPSAgent([x, y], self)
                 self.grid.place_agent(agent, (x, y))
-                self.schedule.add(agent)
+                self.agents_flat[agent.flat_id] = agent
+        self.index_agents()
+        self.count_strategies()
+        self.update_colours()
 
         self.datacollector_population = DataCollector(
             {"Rock": lambda m: self.count_populations(m, "all_r"),
@@ -190,6 +265,39 @@ class RPSModel(GameGrid):
             {"Num Evolving Agents": "fraction_evolving"}
         )
 
+    def increment_scores(self):
+        """
+        Plays every agent against all eight of its neighbours at once through the neighbour table, see kernels.py.
+        """
+        self.rng.random(out=self._play_rand)
+        np.less(self._play_rand, self.probability_playing, out=self._played)
+        self._played &= self.neighbour_mask
+        score_all(self.moves, self.payoff_matrix, self.neighbour_idx, self._played,
+                  self.scores, self.total_scores)
+
+    def kill_weak(self):
+        """
+        Kills the living agents that fell below the cull score, each with probability_death.
+        """
+        dying = np.less(self._death_rand, self.probability_death, out=self._dying)
+        dying &= self.alive
+        dying &= self.total_scores < self.cull_score
+        self.alive[dying] = False
+        self.num_dying += int(np.count_nonzero(dying))
+
+    def empty_crowded(self):
+        """
+        Empties every agent whose neighbours all share its strategy, compared over the whole grid at once through
+        the neighbour table. Every crowded agent is emptied, probability_death does not apply here.
+        """
+        same = self.strategies[self.neighbour_idx] == self.strategies[:, np.newaxis]
+        same |= ~self.neighbour_mask
+        crowded = same.all(axis=1) & (self.strategies != EMPTY)
+        self.strategies[crowded] = EMPTY
+        self.moves[crowded] = MOVE_CODES["E"]
+        self.alive[crowded] = False
+        self.num_dead += int(np.count_nonzero(crowded))
+
     def step(self):
         self.step_num += 1
         logger.warn("STEP NUMBER: {} \n".format(self.step_num))
@@ -199,18 +307,37 @@ class RPSModel(GameGrid):
         self.num_evolving = 0
         self.num_dying = 0
 
-        for agent in self.schedule.agents:
-            agent.increment_score()
-        for agent in self.schedule.agents:
-            agent.kill_weak()
-        for agent in self.schedule.agents:
-            logger.warn("\nAgent {} is being reproduced, mutated and updated".format(agent.unique_id))
-            agent.reproduce_strong()
-        for agent in self.schedule.agents:
-            agent.update_strategy()
-            agent.implement_strategy()
-        for agent in self.schedule.agents:
-            agent.exchange()
+        # the random numbers the agents need this step are drawn together and looked up by flat_id
+        self.rng.random(out=self._step_rand)
+
+        self.rng.shuffle(self.agent_order)
+
+        self.increment_scores()
+        self.kill_weak()
+        if compiled:
+            num_dead, self.num_evolving, self.num_mutating = reproduce_all(
+                self.strategies, self.alive, self.total_scores, self.scores, self.neighbour_idx, self.neighbour_mask,
+                self.agent_strategy_codes, self._adopt_rand, self._mut_rand, self._mut_choice_rand,
+                self.probability_adoption, self.probability_mutation, self.new_strategies)
+            self.num_dead += num_dead
+        else:
+            for agent in self.agents_flat[self.agent_order]:
+                logger.warn("\nAgent {} is being reproduced, mutated and updated".format(agent.unique_id))
+                agent.reproduce_strong()
+        # the new strategies are double buffered so every agent reproduced from the same old strategies
+        np.copyto(self.strategies, self.new_strategies)
+        # every agent implements its new strategy with one lookup over the whole grid
+        np.take(STRATEGY_TO_MOVE, self.strategies, out=self.moves)
+        # the exchange only writes new_strategies, which the next step's reproduction overwrites before it is read,
+        # so swaps never reach the grid. The pass is kept only for parity with the original schedule, it is not a
+        # working rule
+        if compiled:
+            exchange_all(self.agent_order, self.strategies, self.neighbour_idx, self.neighbour_mask,
+                         self._exchange_rand, self._exchange_choice_rand, self.probability_exchange,
+                         self.new_strategies)
+        else:
+            for agent in self.agents_flat[self.agent_order]:
+                agent.exchange()
 
         logger.warn("\nThere are in total:"
                      "\n{} agents dead"
@@ -221,9 +348,10 @@ class RPSModel(GameGrid):
         ))
 
         if self.kill_crowded:
-            for player in self.crowded_players:
-                player.strategy = "empty"
+            self.empty_crowded()
 
+        self.count_strategies()
+        self.update_colours()
         self.datacollector_score.collect(self)
         self.datacollector_population.collect(self)
 
@@ -3,7 +3,6 @@ from mesa.visualization.ModularVisualization import ModularServer
 from .config import Config
 from .model import RPSModel
 import copy
-from colour import Color
 from .logger import logger
 from game_theory.visualization.HistogramVisualization import HistogramModule
 
@@ -20,14 +19,9 @@ def agent_portrayal(agent):
                  "Filled": "true",
                  "Layer": 0}
 
-    if agent.strategy == "all_r":
-        portrayal["Color"] = "red"
-    if agent.strategy == "all_p":
-        portrayal["Color"] = "green"
-    if agent.strategy == "all_s":
-        portrayal["Color"] = "blue"
-    if agent.strategy == "empty":
-        portrayal["Color"] = "black"
+    # the colours are looked up for the whole grid once per step by the model
+    r, g, b = agent.model.color_grid[agent.pos]
+    portrayal["Color"] = "#{:02x}{:02x}{:02x}".format(r, g, b)
 
     return portrayal
 
@@ -18,6 +18,5 @@ class HistogramModule(VisualizationElement):
         self.js_code = "elements.push(" + new_element + ");"
 
     def render(self, model):
-        score_vals = [agent.total_score for agent in model.schedule.agents]
-        hist = np.histogram(score_vals, bins=self.bins)[0]
+        hist = np.histogram(model.total_scores, bins=self.bins)[0]
         return [int(x) for x in hist]